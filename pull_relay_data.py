@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
-import base64
+import binascii
 import bz2
 import csv
 import datetime as dt
+import itertools
 import sys
 import time
 import urllib.request
@@ -11,14 +12,13 @@ import lzma
 import re
 import tarfile
 import os
-from io import BytesIO
+import shutil
 
 def log(msg: str):
     print(msg, file=sys.stderr, flush=True)
 
 
 ARCHIVE_BASE = "https://collector.torproject.org/archive/relay-descriptors/consensuses"
-NAME_PAT = r"(?:consensuses-)?{date}-{hh}-00-00(?:-00)?-consensus(?:\.(?:xz|bz2))?$"
 
 
 def daterange(start_date, end_date):
@@ -28,8 +28,8 @@ def daterange(start_date, end_date):
         day += dt.timedelta(days=1)
 
 
-def fetch_from_month_tar(day: dt.date, hour: int, timeout=60):
-    month = day.strftime('%Y-%m')
+def month_tar_path(month: str, timeout=60):
+    """Return the cached consensuses-<month>.tar.xz path, downloading it on first use."""
     month_url = f"{ARCHIVE_BASE}/consensuses-{month}.tar.xz"
 
     cache_dir = os.path.join(".cache", "tor-consensuses")
@@ -39,107 +39,104 @@ def fetch_from_month_tar(day: dt.date, hour: int, timeout=60):
     # use cache if present
     if os.path.exists(cache_path):
         log(f"    • Using cached tar: {cache_path}")
-        with open(cache_path, "rb") as fh:
-            blob = fh.read()
     else:
         log(f"    • Downloading tar: {month_url}")
         req = urllib.request.Request(month_url, headers={"User-Agent": "tor-relay-data/1.0 (+research use)"})
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            blob = resp.read()
-        with open(cache_path, "wb") as fh:
-            fh.write(blob)
+        # stream to a temp file so a failed download never leaves a truncated cache entry
+        tmp_path = cache_path + ".part"
+        with urllib.request.urlopen(req, timeout=timeout) as resp, open(tmp_path, "wb") as fh:
+            shutil.copyfileobj(resp, fh, 1 << 20)
+        os.replace(tmp_path, cache_path)
         log(f"    • Saved cache: {cache_path}")
 
-    datestr = day.strftime("%Y-%m-%d")
-    hh = f"{hour:02d}"
-    pat = re.compile(NAME_PAT.format(date=re.escape(datestr), hh=re.escape(hh)))
-
-    with tarfile.open(fileobj=BytesIO(blob), mode="r:xz") as tf:
-        for m in tf.getmembers():
-            base = m.name.split("/")[-1]
-            if pat.match(base):
-                f = tf.extractfile(m)
-                data = f.read()
-                if base.endswith(".xz"):
-                    data = lzma.decompress(data)
-                elif base.endswith(".bz2"):
-                    data = bz2.decompress(data)
-                log(f"    ✓ Found in tar: {base}")
-                return data.decode("utf-8", errors="replace")
-
-    raise RuntimeError(
-        f"Consensus for {datestr} {hh}:00 not found in {month_url}. "
-        f"Tried patterns like {datestr}-{hh}-00-00[-00]-consensus[.xz|.bz2]."
-    )
-
-def fetch_consensus(day: dt.date, hours, timeout=60):
-    last_err = None
-    for hour in hours:
-        try:
-            log(f"  ↳ Using month tar for {day.isoformat()} @ {hour:02d}:00")
-            text = fetch_from_month_tar(day, hour, timeout=max(timeout, 60))
-            log(f"    ✓ Selected hour {hour:02d} for {day.isoformat()}")
-            return text, hour
-        except Exception as e:
-            last_err = e
-            log(f"    ✗ Not in tar for hour {hour:02d}: {e}")
-            continue
-    raise RuntimeError(f"Failed to fetch consensus for {day.isoformat()}: {last_err}")
-
-def b64_to_hex(b64_id: str) -> str:
+    return cache_path
+
+
+def consensus_names(datestr: str, hh: str):
+    # All accepted spellings: [consensuses-]<date>-<hh>-00-00[-00]-consensus[.xz|.bz2]
+    return [
+        f"{prefix}{datestr}-{hh}-00-00{secs}-consensus{ext}"
+        for prefix in ("", "consensuses-")
+        for secs in ("", "-00")
+        for ext in ("", ".xz", ".bz2")
+    ]
+
+
+def scan_month_tar(month: str, days, hours, timeout=60):
+    """
+    Stream one month tar in a single sequential pass and pick, for each day,
+    the consensus at the most preferred hour available.
+    Returns dict[date] = (used_hour, dict[fingerprint]=bandwidth).
+    """
+    wanted = {}
+    for day in days:
+        datestr = day.strftime("%Y-%m-%d")
+        for rank, hour in enumerate(hours):
+            for name in consensus_names(datestr, f"{hour:02d}"):
+                wanted.setdefault(name, (day, rank))
+
+    picked = {}   # day -> (rank, hour, mapping)
+    cache_path = month_tar_path(month, timeout=timeout)
+    # 'r|' reads the tar strictly sequentially, so only the current member is
+    # ever held in memory rather than the whole decompressed archive.
+    with lzma.open(cache_path, "rb") as xz, tarfile.open(fileobj=xz, mode="r|") as tf:
+        for m in tf:
+            base = m.name.rsplit("/", 1)[-1]
+            hit = wanted.get(base)
+            if hit is None:
+                continue
+            day, rank = hit
+            if day in picked and picked[day][0] <= rank:
+                continue
+
+            data = tf.extractfile(m).read()
+            if base.endswith(".xz"):
+                data = lzma.decompress(data)
+            elif base.endswith(".bz2"):
+                data = bz2.decompress(data)
+            log(f"    ✓ Found in tar: {base}")
+            picked[day] = (rank, hours[rank], parse_consensus(data))
+
+            # every day already has its preferred hour; skip the rest of the archive
+            if len(picked) == len(days) and all(r == 0 for r, _, _ in picked.values()):
+                break
+
+    for day in days:
+        if day not in picked:
+            raise RuntimeError(
+                f"Failed to fetch consensus for {day.isoformat()}: no hour in {hours} found in "
+                f"consensuses-{month}.tar.xz (tried names like "
+                f"{day.isoformat()}-HH-00-00[-00]-consensus[.xz|.bz2])"
+            )
+        log(f"    ✓ Selected hour {picked[day][1]:02d} for {day.isoformat()}")
+
+    return {day: (hour, mapping) for day, (_, hour, mapping) in picked.items()}
+
+_DECODE = binascii.a2b_base64
+
+def b64_to_hex(b64_id: bytes) -> str:
     # Identity on 'r' line is base64 (20 bytes). Convert to UPPERCASE hex fingerprint.
-    # Base64 can be unpadded in consensus; add padding if necessary.
-    padding = '=' * (-len(b64_id) % 4)
-    raw = base64.b64decode(b64_id + padding)
-    return raw.hex().upper()
+    # Consensus ids are unpadded 27-char base64, so the padding is always a single '='.
+    return _DECODE(b64_id + b"=").hex().upper()
+
+# r <nickname> <id> ..., then any non-r/w lines (s, v, pr, ...), then w ... Bandwidth=NNNN
+ENTRY_PAT = re.compile(
+    rb"^r \S+ (\S+)[^\n]*\n(?:[^rw\n][^\n]*\n)*w (?:[^\n]* )?Bandwidth=(\d+)",
+    re.M,
+)
 
-def parse_consensus(consensus_text: str):
+def parse_consensus(data: bytes):
     """
     Returns dict[fingerprint_hex] = advertised_bandwidth (int).
-      - read 'r' lines to get the relay's identity (base64) -> fingerprint hex
-      - then read following 'w' line for 'Bandwidth=<int>'
+      - scan the raw consensus bytes once for each 'r' line and its following 'w' line
+      - 'r' identity (base64) -> fingerprint hex, 'w' -> 'Bandwidth=<int>'
     """
     results = {}
-    current_fp = None
-
-    for line in consensus_text.splitlines():
-        if not line:
-            continue
-
-        if line.startswith("r "):
-            # r <nickname> <id> <digest> <pub1> <pub2> <ip> <orport> <dirport>
-            parts = line.split()
-            if len(parts) >= 3:
-                b64id = parts[2]
-                try:
-                    current_fp = b64_to_hex(b64id)
-                except Exception:
-                    current_fp = None
-            else:
-                current_fp = None
-
-        elif current_fp and line.startswith("w "):
-            # w Bandwidth=NNNN [Measured=...] ...
-            # Pull the Bandwidth field
-            try:
-                parts = line.split()
-                bw = None
-                for p in parts[1:]:
-                    if p.startswith("Bandwidth="):
-                        bw = int(p.split("=", 1)[1])
-                        break
-                if bw is not None:
-                    results[current_fp] = bw
-            except Exception:
-                pass
-            finally:
-                # reset to avoid accidentally pairing the same 'w' with next relay
-                current_fp = None
-
-        else:
-            # lines like 's', 'v', etc. ignore
+    for m in ENTRY_PAT.finditer(data):
+        try:
+            results[b64_to_hex(m.group(1))] = int(m.group(2))
+        except Exception:
             pass
-
     return results
 
 def build_panel(start_date, end_date, hours):
@@ -149,38 +146,51 @@ def build_panel(start_date, end_date, hours):
       common_relays: set of fingerprints present every day
     """
     per_day = []
-    for day in daterange(start_date, end_date):
+    # Each month tar is streamed once and every requested (day, hour) in that
+    # month is satisfied in the same pass.
+    for month, days in itertools.groupby(daterange(start_date, end_date), key=lambda d: d.strftime("%Y-%m")):
+        days = list(days)
         t0 = time.time()
-        log(f"[{day.isoformat()}] Fetching consensus (hours tried: {hours})...")
-        text, used_hour = fetch_consensus(day, hours)
-        mapping = parse_consensus(text)
+        log(f"[{month}] Scanning month tar for {len(days)} day(s) (hours tried: {hours})...")
+        picked = scan_month_tar(month, days, hours)
+        for day in days:
+            used_hour, mapping = picked[day]
+            log(f"[{day.isoformat()}] Parsed relays: {len(mapping):,}")
+            per_day.append((day, used_hour, mapping))
         dt_s = time.time() - t0
-        log(f"[{day.isoformat()}] Parsed relays: {len(mapping):,} (in {dt_s:.1f}s)")
-        per_day.append((day, used_hour, mapping))
+        log(f"[{month}] Done in {dt_s:.1f}s")
 
     # Intersection of relays present all days
     if not per_day:
         return [], set()
 
-    common = set(per_day[0][2].keys())
-    for _, _, m in per_day[1:]:
-        common &= set(m.keys())
-
+    # Start from the smallest day (e.g. a partial consensus) so every later
+    # intersection only probes that many relays.
+    mappings = sorted((m for _, _, m in per_day), key=len)
+    common = set(mappings[0])
+    for m in mappings[1:]:
+        common.intersection_update(m)
+        if not common:
+            break
 
     return per_day, common
 
 def write_csv(per_day, common_relays, out_path):
     # CSV format: date,fingerprint,relay_bandwidth,timestamp
     # timestamp = ISO string at selected hour (only know the consensus hour from the URL pattern).
-    with open(out_path, "w", newline="") as f:
+    # Relays are written in sorted order so the output is deterministic across runs.
+    common_list = sorted(common_relays)
+    with open(out_path, "w", newline="", buffering=1 << 20) as f:
         w = csv.writer(f)
         w.writerow(["date", "hour", "fingerprint", "relay_bandwidth", "timestamp"])
         for day, used_hour, mapping in per_day:
+            date_s = day.isoformat()
             stamp = dt.datetime.combine(day, dt.time(used_hour, 0, 0)).isoformat()
-            for fp in common_relays:
-                bw = mapping.get(fp)
-                if bw is not None:
-                    w.writerow([day.isoformat(), used_hour, fp, bw, stamp])
+            w.writerows([
+                (date_s, used_hour, fp, bw, stamp)
+                for fp in common_list
+                if (bw := mapping.get(fp)) is not None
+            ])
 
 
 def parse_args():
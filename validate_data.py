@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 import hashlib
-import datetime as dt
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import xxhash
+
+CHUNK_ROWS = 1_000_000
+MMAP_HASH_MIN = 64 * 1024 * 1024
+TIMESTAMP_PAT = r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
 
 def die(msg, code=2):
     print(f"VALIDATION ERROR: {msg}", file=sys.stderr)
@@ -12,124 +22,215 @@ def die(msg, code=2):
 def parse_args():
     p = argparse.ArgumentParser(description="Validate tor daily bandwidth panel CSV (inferred dates).")
     p.add_argument("csv", help="Path to daily_bw.csv")
+    p.add_argument("--sha256", action="store_true",
+                   help="Report a SHA-256 digest instead of the (much faster, non-cryptographic) XXH3-128 fingerprint")
     return p.parse_args()
 
-def daterange(d0, d1):
-    days, d = [], d0
-    while d <= d1:
-        days.append(d)
-        d += dt.timedelta(days=1)
-    return days
+def hash_file(path, h, bufsize=1 << 20):
+    with open(path, "rb", buffering=0) as fh:
+        # Large files: hash straight from an mmap, skipping the kernel -> user
+        # copy; MADV_SEQUENTIAL lets the kernel read ahead and drop pages behind.
+        if os.fstat(fh.fileno()).st_size > MMAP_HASH_MIN:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            return h.hexdigest()
+
+        # Otherwise stream through a reusable 1 MiB buffer instead of reading it whole.
+        mv = memoryview(bytearray(bufsize))
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while n := fh.readinto(mv):
+            h.update(mv[:n])
+    return h.hexdigest()
+
+def encode(values, index):
+    # Factorize one chunk (a categorical just reuses its codes) and map them
+    # onto the cross-chunk index; NA stays -1.
+    codes, uniques = pd.factorize(values)
+    lookup = np.array([index.setdefault(u, len(index)) for u in uniques] + [-1], dtype=np.int32)
+    return lookup[codes]
+
+def read_chunks(path, usecols, chunksize=CHUNK_ROWS):
+    # Typed columns make the parser reject non-numeric cells outright.
+    try:
+        yield from pd.read_csv(
+            path,
+            chunksize=chunksize,
+            engine="c",
+            usecols=usecols,
+            dtype_backend="pyarrow",
+            dtype={
+                # dictionary-encoded by the parser: one string per distinct
+                # relay, int codes per row
+                "fingerprint": "category",
+                "timestamp": "string[pyarrow]",
+                "relay_bandwidth": "int64[pyarrow]",
+                "hour": "int8[pyarrow]",
+            },
+        )
+    except Exception as e:
+        die(f"Failed to read CSV: {e}")
 
 def main():
     args = parse_args()
 
-    # Hash (for reproducibility in logs)
-    with open(args.csv, "rb") as fh:
-        digest = hashlib.sha256(fh.read()).hexdigest()
-
-    # Load + schema
+    # Schema (header only), checked before any full pass over the file
+    required = ["date", "fingerprint", "relay_bandwidth", "timestamp"]
     try:
-        df = pd.read_csv(args.csv, dtype={"fingerprint": "string"})
+        header = pd.read_csv(args.csv, nrows=0).columns
     except Exception as e:
         die(f"Failed to read CSV: {e}")
-
-    required = ["date", "fingerprint", "relay_bandwidth", "timestamp"]
-    missing = [c for c in required if c not in df.columns]
+    missing = [c for c in required if c not in header]
     if missing:
         die(f"Missing required columns: {missing}")
-
-    # Types & basic sanity
-    try:
-        df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d", errors="raise").dt.date
-    except Exception as e:
-        die(f"Bad 'date' values: {e}")
-
-    try:
-        pd.to_datetime(df["timestamp"], errors="raise")
-    except Exception as e:
-        die(f"Bad 'timestamp' values: {e}")
-
-    df["relay_bandwidth"] = pd.to_numeric(df["relay_bandwidth"], errors="coerce")
-    if df["relay_bandwidth"].isna().any():
-        die(f"'relay_bandwidth' has {int(df['relay_bandwidth'].isna().sum())} non-numeric cells")
-    if (df["relay_bandwidth"] < 0).any():
-        die(f"'relay_bandwidth' has {int((df['relay_bandwidth'] < 0).sum())} negative values")
-
-    if df.isna().any().any():
-        die("Found NA/null values in the dataset")
-
-    # No duplicate (date, fingerprint)
-    dup = int(df.duplicated(subset=["date", "fingerprint"]).sum())
+    # Only load what the checks use; extra metadata columns are never parsed.
+    usecols = [c for c in header if c in required or c == "hour"]
+
+    # Hash (for reproducibility in logs, so a content fingerprint is enough by
+    # default). Runs in a background thread so it overlaps with the CSV parse;
+    # both hashers release the GIL while hashing.
+    hash_label, hasher = ("SHA256", hashlib.sha256()) if args.sha256 else ("XXH3-128", xxhash.xxh3_128())
+    pool = ThreadPoolExecutor(max_workers=1)
+    hash_future = pool.submit(hash_file, args.csv, hasher)
+    pool.shutdown(wait=False)
+
+    # Stream the file in chunks; it is never held as a DataFrame. Across chunks
+    # the whole file is kept only as packed per-row integer arrays (days,
+    # fingerprint codes, hours) plus counters.
+    fp_index = {}        # fingerprint -> code, shared by all chunks
+    d_parts, f_parts = [], []
+    h_parts = []
+    n_rows = n_null_bw = n_neg = zeros = huge = 0
+    na_col = None        # first column found to contain NA
+
+    for chunk in read_chunks(args.csv, usecols):
+        try:
+            chunk["date"] = pd.to_datetime(chunk["date"], format="%Y-%m-%d", errors="raise")
+        except Exception as e:
+            die(f"Bad 'date' values: {e}")
+
+        # Shape check only: the parsed timestamps were never used, so skip the
+        # full datetime parse. NA cells are left to the NA check below.
+        ts_ok = chunk["timestamp"].str.fullmatch(TIMESTAMP_PAT, na=True)
+        if not ts_ok.all():
+            first_bad = chunk["timestamp"][~ts_ok].iloc[0]
+            die(f"Bad 'timestamp' values: {first_bad!r} does not look like YYYY-MM-DD[T ]HH:MM:SS")
+
+        # Arrow keeps a null count alongside the validity bitmap, so nulls cost
+        # nothing to count; without nulls the values are a zero-copy int64 view.
+        bw = pa.array(chunk["relay_bandwidth"].array)
+        n_rows += len(chunk)
+        n_null_bw += bw.null_count
+        a = (pc.drop_null(bw) if bw.null_count else bw).to_numpy()
+        n_neg += int(np.count_nonzero(a < 0))
+        zeros += int(np.count_nonzero(a == 0))
+        huge += int(np.count_nonzero(a > 10**9))
+        if na_col is None:
+            # column by column, stopping at the first hit; never builds a frame-sized mask
+            na_col = next((c for c in chunk.columns if chunk[c].isna().values.any()), None)
+
+        # datetime64[D]: packed integers, no per-row datetime.date objects
+        days = chunk["date"].to_numpy().astype("datetime64[D]")
+        d_parts.append(days)
+        f_parts.append(encode(chunk["fingerprint"], fp_index))
+
+        if "hour" in chunk.columns:
+            # na_value only keeps the conversion from raising; an empty hour
+            # already set na_col, so the run stops before the hour report.
+            h_parts.append(chunk["hour"].to_numpy(dtype=np.int8, na_value=0))
+
+    if not n_rows:
+        die("CSV has no data rows")
+
+    if n_null_bw:
+        die(f"'relay_bandwidth' has {n_null_bw} empty cells")
+    if n_neg:
+        die(f"'relay_bandwidth' has {n_neg} negative values")
+
+    if na_col is not None:
+        die(f"Found NA/null values in the dataset (column '{na_col}')")
+
+    # Day × fingerprint occupancy matrix; np.unique yields the days sorted
+    days_present, first_row, d_codes = np.unique(np.concatenate(d_parts), return_index=True, return_inverse=True)
+    f_codes = np.concatenate(f_parts)
+    occ = np.zeros((len(days_present), len(fp_index)), dtype=bool)
+    occ[d_codes, f_codes] = True
+    per_day = occ.sum(axis=1)
+
+    # No duplicate (date, fingerprint): each one is a row that set no new cell
+    dup = n_rows - int(per_day.sum())
     if dup:
         die(f"Found {dup} duplicate (date,fingerprint) rows")
 
     # Date coverage: no gaps
-    days_present = sorted(set(df["date"].tolist()))
-    d0, d1 = min(days_present), max(days_present)
-    expected_days = daterange(d0, d1)
-    if set(days_present) != set(expected_days):
-        missing_days = [d for d in expected_days if d not in days_present]
+    d0, d1 = days_present[0], days_present[-1]
+    expected_days = np.arange(d0, d1 + np.timedelta64(1, "D"), dtype="datetime64[D]")
+    missing_days = np.setdiff1d(expected_days, days_present, assume_unique=True)
+    if len(missing_days):
         die(f"Date coverage has gaps: missing {len(missing_days)} day(s); first few: {', '.join(map(str, missing_days[:10]))}")
 
     # Fingerprint set must be identical every day
-    by_day = {d: set(g["fingerprint"]) for d, g in df.groupby("date")}
-    sizes = {d: len(s) for d, s in by_day.items()}
-    if len(set(sizes.values())) != 1:
-        preview = ", ".join([f"{d}:{sizes[d]}" for d in sorted(sizes)[:10]])
+    if per_day.min() != per_day.max():
+        preview = ", ".join([f"{d}:{n}" for d, n in zip(days_present[:10], per_day[:10])])
         die(f"Per-day row counts vary across days (first 10 shown: {preview})")
 
-    common = set.intersection(*by_day.values()) if by_day else set()
-    for d, s in by_day.items():
-        if s != common:
-            die(f"Common-set mismatch on {d}: missing {len(common - s)}, extra {len(s - common)}")
+    # With equal sizes, the sets are identical iff every day holds every
+    # fingerprint seen, so the happy path is a single integer compare.
+    if per_day[0] != len(fp_index):
+        common = occ.all(axis=0)
+        i = int(np.flatnonzero((occ & ~common).any(axis=1))[0])
+        extra = int((occ[i] & ~common).sum())
+        die(f"Common-set mismatch on {days_present[i]}: missing 0, extra {extra}")
+    n_common = len(fp_index)
 
     # Light bandwidth outlier notes (non-fatal)
-    zeros = int((df["relay_bandwidth"] == 0).sum())
     if zeros > 0:
         print(f"NOTE: {zeros} rows have relay_bandwidth == 0", file=sys.stderr)
-    huge = int((df["relay_bandwidth"] > 10**9).sum())
     if huge > 0:
         print(f"NOTE: {huge} rows have very large relay_bandwidth (>1e9)", file=sys.stderr)
 
     # Row count matches days × common
     n_days = len(expected_days)
-    n_common = len(common)
-    n_rows = len(df)
     if n_rows != n_days * n_common:
         die(f"Row count mismatch: rows={n_rows} but days×common={n_days*n_common}")
 
     # Hour diagnostics (if present)
-    if "hour" in df.columns:
-        df["hour"] = pd.to_numeric(df["hour"], errors="coerce").astype("Int64")
-        if df["hour"].isna().any():
-            die(f"'hour' has {int(df['hour'].isna().sum())} non-numeric cells")
-
-        per_day_hour = df.groupby("date")["hour"].nunique()
-        days_multi_hours = int((per_day_hour > 1).sum())
-        hour_counts = df.drop_duplicates(["date","hour"])["hour"].value_counts().sort_index()
+    if "hour" in usecols:
+        # One np.unique over packed (day, hour) keys gives every distinct pair;
+        # hours are read as int8, so +128 maps each one to a byte 0..255.
+        hours = np.concatenate(h_parts)
+        pairs = np.unique(d_codes * 256 + (hours.astype(np.int64) + 128))
+        pair_day, pair_hour = pairs // 256, pairs % 256
+        days_multi_hours = int(np.count_nonzero(np.bincount(pair_day, minlength=len(days_present)) > 1))
+        hour_counts = np.bincount(pair_hour, minlength=256)
 
         print("\nHour usage across days:")
-        for h, c in hour_counts.items():
-            print(f"  - {int(h):02d}:00 → {c} day(s)")
+        for h in np.flatnonzero(hour_counts):
+            print(f"  - {h - 128:02d}:00 → {hour_counts[h]} day(s)")
 
         if days_multi_hours:
             print(f"WARNING: {days_multi_hours} day(s) have multiple different hours in the CSV")
 
-        off_zero = df.groupby("date")["hour"].first().loc[lambda s: s != 0]
+        # hour of each day's first row in file order
+        first_hour = hours[first_row]
+        off_zero = np.flatnonzero(first_hour != 0)
         if len(off_zero):
             print(f"Days not at 00:00 ({len(off_zero)}):")
-            for d, h in off_zero.items():
-                print(f"  {d} @ {int(h):02d}:00")
+            for i in off_zero:
+                print(f"  {days_present[i]} @ {first_hour[i]:02d}:00")
     else:
         print("\nNOTE: No 'hour' column found; cannot report hour variation.")
 
+    digest = hash_future.result()
+
     # OK summary
     print("VALIDATION Summary")
     print("------------------")
     print("Passed all checks: No duplicate fingerprints, missing days, all days aligned.")
     print(f"- File: {args.csv}")
-    print(f"- SHA256: {digest}")
+    print(f"- {hash_label}: {digest}")
     print(f"- Dates: {d0} → {d1} (inclusive) = {n_days} days")
     print(f"- Common relays: {n_common:,}")
     print(f"- Total rows: {n_rows:,} (days × common = {n_days} × {n_common})")